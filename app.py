@@ -1,9 +1,26 @@
-from flask import Flask, request
+from flask import Flask, Response, request
 import requests
 import os
+import atexit
+import bisect
+import hashlib
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from supabase import create_client, Client
 from openai import OpenAI
 import json
+import math
+from datetime import datetime, timezone
 
 app = Flask(__name__)
 
@@ -22,6 +39,70 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 client_ai = OpenAI(api_key=OPENAI_API_KEY)
 
+# "async": el webhook encola y responde al instante (recomendado).
+# "sync": procesa dentro de la petición, como antes.
+MODO_DESPACHO = os.environ.get("MODO_DESPACHO", "async")
+NUM_WORKERS = int(os.environ.get("NUM_WORKERS", 16))
+MAX_PENDIENTES = int(os.environ.get("MAX_PENDIENTES", 1000))
+TIMEOUT_ENCOLAR = float(os.environ.get("TIMEOUT_ENCOLAR", 0.05))  # segundos
+# Tiempo total para apagar (vaciar la cola + guardar mensajes pendientes). Debe
+# quedar por debajo del graceful_timeout de gunicorn (30 s por defecto) o el
+# worker recibe SIGKILL a medio vaciar.
+TIMEOUT_DRENADO = float(os.environ.get("TIMEOUT_DRENADO", 25))    # segundos
+
+# Caché del estado de clientes. Cada proceso tiene la suya: con varios workers
+# de gunicorn (WEB_CONCURRENCY > 1, como en Heroku) otro worker puede cambiar
+# el estado, así que el TTL por defecto baja a unos segundos para que el flujo
+# "Agendar" no lea un estado viejo. Con un solo worker puede ser largo.
+WORKERS_WEB = max(int(os.environ.get("WEB_CONCURRENCY", 1)), 1)
+VARIOS_WORKERS = WORKERS_WEB > 1
+CACHE_CLIENTES_TTL = float(os.environ.get("CACHE_CLIENTES_TTL", 2 if VARIOS_WORKERS else 600))  # segundos
+CACHE_CLIENTES_MAX = int(os.environ.get("CACHE_CLIENTES_MAX", 10000))
+
+# Historial de conversación: últimos N turnos en memoria, escritura diferida a Supabase.
+# También es por proceso: con varios workers los turnos que atendió otro worker
+# solo se ven al recargar de Supabase, así que el TTL por defecto baja a unos
+# segundos. Aun así, una recarga no ve las filas que otro worker todavía tiene
+# en su buffer (hasta INTERVALO_FLUSH de retraso, más si Supabase está fallando).
+HISTORIAL_TURNOS = int(os.environ.get("HISTORIAL_TURNOS", 6))
+CACHE_HISTORIAL_TTL = float(os.environ.get("CACHE_HISTORIAL_TTL", 2 if VARIOS_WORKERS else 3600))  # segundos
+CACHE_HISTORIAL_MAX = int(os.environ.get("CACHE_HISTORIAL_MAX", 10000))
+LOTE_MENSAJES = int(os.environ.get("LOTE_MENSAJES", 50))
+INTERVALO_FLUSH = float(os.environ.get("INTERVALO_FLUSH", 1.0))           # segundos
+MAX_BUFFER_MENSAJES = int(os.environ.get("MAX_BUFFER_MENSAJES", 5000))
+
+# Caché de respuestas de OpenAI. CACHE_IA_SQLITE (ruta a un archivo) la hace
+# persistente y compartida entre workers de gunicorn; vacío = solo memoria.
+MODELO_IA = os.environ.get("MODELO_IA", "gpt-4o-mini")
+TEMPERATURA_IA = 0.5  # balance entre creatividad y precisión
+CACHE_IA_TTL = float(os.environ.get("CACHE_IA_TTL", 86400))  # segundos
+CACHE_IA_MAX = int(os.environ.get("CACHE_IA_MAX", 5000))
+CACHE_IA_SQLITE = os.environ.get("CACHE_IA_SQLITE", "")
+
+# Entregas duplicadas y ráfagas de mensajes
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", 86400))   # segundos que recordamos un wamid
+DEDUP_MAX = int(os.environ.get("DEDUP_MAX", 100000))
+# "1" = comparte los wamid vistos entre workers vía la tabla `webhook_eventos`
+# (columna `wamid` como llave primaria)
+DEDUP_SUPABASE = os.environ.get("DEDUP_SUPABASE", "0") == "1"
+# Solo se espera si ya hay otro texto del mismo número en la fila (ráfaga en
+# curso); un mensaje suelto nunca espera. 0 = unir sin esperar.
+VENTANA_RAFAGA = float(os.environ.get("VENTANA_RAFAGA", 0.4))  # segundos
+
+# Respuestas locales: por debajo de este umbral (0-1) la pregunta va a OpenAI
+UMBRAL_INTENCION = float(os.environ.get("UMBRAL_INTENCION", 0.75))
+MAX_PALABRAS_INTENCION = int(os.environ.get("MAX_PALABRAS_INTENCION", 12))
+
+# "stream": la respuesta de la IA sale en varios mensajes conforme se genera.
+# "simple": se espera la respuesta completa y se manda en un solo mensaje.
+MODO_RESPUESTA = os.environ.get("MODO_RESPUESTA", "stream")
+MAX_MENSAJES_RESPUESTA = int(os.environ.get("MAX_MENSAJES_RESPUESTA", 4))
+MIN_CARACTERES_BLOQUE = int(os.environ.get("MIN_CARACTERES_BLOQUE", 160))
+INDICADOR_ESCRIBIENDO = os.environ.get("INDICADOR_ESCRIBIENDO", "1") == "1"
+
+# Mensajes que tarden más que esto (segundos) se registran con su desglose por etapa
+UMBRAL_LENTO = float(os.environ.get("UMBRAL_LENTO", 5))
+
 # ===============================================================
 #  IMÁGENES Y RECURSOS (Punto 7) 🖼️
 # ===============================================================
@@ -51,69 +132,1180 @@ DATOS DEL NEGOCIO:
 Si te preguntan algo fuera de tu tema, responde cortésmente que solo hablas de soluciones VTS.
 """
 
+# ===============================================================
+#  RESPUESTAS RÁPIDAS (Sin IA) 🎯
+# ===============================================================
+# Preguntas frecuentes que se contestan sin llamar a OpenAI.
+# - palabras: si aparece alguna (sin importar acentos/mayúsculas) suma mucha confianza
+# - ejemplos: frases típicas; se comparan por similitud de n-gramas de letras
+# - respuesta: texto a enviar; si hay "botones" se manda como mensaje con botones
+TEXTO_PRECIOS = "💰 **Plan Inicial VTS:**\n\n- **$4,500 MXN/mes**\n- Atención 24/7\n- Infraestructura incluida\n\n¿Te interesa una demo?"
+
+INTENCIONES = [
+    {
+        "nombre": "precio",
+        "palabras": ["precio", "precios", "costo", "costos", "cuesta", "cuestan", "cobran", "tarifa", "mensualidad", "inversion"],
+        "ejemplos": ["precio", "cuanto cuesta", "cual es el precio", "que costo tiene", "cuanto cobran al mes", "precio del chatbot"],
+        "respuesta": TEXTO_PRECIOS,
+    },
+    {
+        "nombre": "horario",
+        "palabras": ["horario", "horarios", "abren", "atienden", "a que hora"],
+        "ejemplos": ["cual es su horario", "a que hora atienden", "que dias abren", "horario de atencion"],
+        "respuesta": "🕘 **Horario:** Lunes a Viernes.\n\n📌 La disponibilidad específica se coordina al agendar tu reunión.",
+        "botones": ["📅 Agendar Cita"],
+    },
+    {
+        "nombre": "producto",
+        "palabras": ["que venden", "que hacen", "a que se dedican", "que ofrecen", "servicios"],
+        "ejemplos": ["que venden", "a que se dedican", "que servicios ofrecen", "que hacen ustedes", "que es vts"],
+        "respuesta": "🚀 **Chatbots con IA para WhatsApp**\n\n✅ Atención **24/7** a tus clientes\n✅ Reducción de carga operativa\n💡 También desarrollamos soluciones de **Ciencia de Datos**.",
+        "botones": ["💰 Ver Precios", "📅 Agendar Cita"],
+    },
+    {
+        "nombre": "demo",
+        "palabras": ["demo", "cita", "reunion", "agendar", "llamada"],
+        "ejemplos": ["quiero una demo", "me gustaria agendar una cita", "podemos tener una reunion", "agendar llamada"],
+        "respuesta": "📅 ¡Con gusto! Toca el botón para coordinar tu reunión:",
+        "botones": ["📅 Agendar Cita"],
+    },
+    {
+        "nombre": "gracias",
+        "palabras": ["gracias", "muchas gracias", "thanks"],
+        "ejemplos": ["gracias", "muchas gracias", "ok gracias", "perfecto gracias"],
+        "respuesta": "¡Con gusto! 😊 Si tienes otra duda, aquí estoy.",
+    },
+]
+
+# Casos que fijan el comportamiento del detector: (frase, intención esperada).
+# None = debe ir a la IA. Se revisan al arrancar (y con `python -m benchmark.intenciones`);
+# si cambias INTENCIONES o el umbral, agrega aquí el caso que motivó el cambio.
+CASOS_INTENCIONES = [
+    ("¿Cuánto cuesta?", "precio"),
+    ("cuanto cobran", "precio"),
+    ("cual es el precio?", "precio"),
+    ("cual es su horario", "horario"),
+    ("horarios de atencion", "horario"),
+    ("que venden?", "producto"),
+    ("¿A qué se dedican?", "producto"),
+    ("quiero una demo", "demo"),
+    ("Gracias!!", "gracias"),
+    ("ok muchas gracias", "gracias"),
+    ("el precio incluye IVA?", None),
+    ("no me interesa el precio", None),
+    ("cuanto cuesta el plan anual con descuento", None),
+    ("necesito cancelar mi cita", None),
+    ("qué servicios de ciencia de datos ofrecen?", None),
+    ("precio y horario?", None),
+    ("se puede integrar con mi CRM?", None),
+    ("precios", "precio"),
+]
+
+# ===============================================================
+#  MÉTRICAS (Formato Prometheus) 📈
+# ===============================================================
+BUCKETS_SEGUNDOS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metricas:
+    """Contadores, gauges e histogramas en memoria, exportados en texto Prometheus.
+
+    Cada worker de gunicorn tiene los suyos. Registrar una observación es un
+    bisect y una suma bajo un lock, así que puede quedarse activo con carga.
+    """
+
+    def __init__(self, buckets=BUCKETS_SEGUNDOS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._contadores = {}   # (nombre, etiquetas) -> valor
+        self._gauges = {}       # (nombre, etiquetas) -> valor
+        self._histogramas = {}  # (nombre, etiquetas) -> [conteo por bucket..., +Inf, suma]
+        self._recolectores = [] # funciones que devuelven [(tipo, nombre, etiquetas, valor)] al exportar
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def ajustar(self, nombre, delta, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._gauges[clave] = self._gauges.get(clave, 0) + delta
+
+    def observar(self, nombre, segundos, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        i = bisect.bisect_left(self.buckets, segundos)
+        with self._lock:
+            h = self._histogramas.get(clave)
+            if h is None: h = self._histogramas[clave] = [0] * (len(self.buckets) + 2)
+            h[i] += 1
+            h[-1] += segundos
+
+    def recolector(self, funcion):
+        self._recolectores.append(funcion)
+        return funcion
+
+    @staticmethod
+    def _etiquetas(etiquetas):
+        if not etiquetas: return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in etiquetas) + "}"
+
+    def exportar(self):
+        # El formato exige cada familia (nombre) en un bloque contiguo con su # TYPE
+        familias = {}  # nombre -> (tipo, [líneas])
+        def linea(nombre, tipo, texto):
+            familias.setdefault(nombre, (tipo, []))[1].append(texto)
+
+        with self._lock:
+            contadores = sorted(self._contadores.items())
+            gauges = sorted(self._gauges.items())
+            histogramas = sorted((k, list(v)) for k, v in self._histogramas.items())
+        extra = []
+        for funcion in self._recolectores:
+            try:
+                extra.extend(funcion())
+            except Exception as e:
+                print(f"⚠️ Error en recolector de métricas: {e}")
+
+        for (nombre, etiquetas), valor in contadores:
+            linea(nombre, "counter", f"{nombre}{self._etiquetas(etiquetas)} {valor}")
+        for (nombre, etiquetas), valor in gauges:
+            linea(nombre, "gauge", f"{nombre}{self._etiquetas(etiquetas)} {valor}")
+        for t, nombre, etiquetas, valor in extra:
+            linea(nombre, t, f"{nombre}{self._etiquetas(tuple(sorted(etiquetas.items())))} {valor}")
+        for (nombre, etiquetas), h in histogramas:
+            acumulado = 0
+            for le, conteo in zip([*self.buckets, "+Inf"], h[:-1]):
+                acumulado += conteo
+                linea(nombre, "histogram", f"{nombre}_bucket{self._etiquetas(etiquetas + (('le', le),))} {acumulado}")
+            linea(nombre, "histogram", f"{nombre}_sum{self._etiquetas(etiquetas)} {h[-1]}")
+            linea(nombre, "histogram", f"{nombre}_count{self._etiquetas(etiquetas)} {acumulado}")
+
+        salida = []
+        for nombre, (tipo, lineas) in familias.items():
+            salida.append(f"# TYPE {nombre} {tipo}")
+            salida.extend(lineas)
+        return "\n".join(salida) + "\n"
+
+metricas = Metricas()
+_traza = threading.local()  # desglose por etapa del mensaje que atiende este hilo
+
+@contextmanager
+def medir(etapa, **etiquetas):
+    """Mide una etapa: histograma de duración, contador de errores y desglose del mensaje."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metricas.contar("vts_errores_total", etapa=etapa)
+        raise
+    finally:
+        duracion = time.perf_counter() - inicio
+        metricas.observar("vts_etapa_segundos", duracion, etapa=etapa, **etiquetas)
+        etapas = getattr(_traza, "etapas", None)
+        if etapas is not None: etapas[etapa] = etapas.get(etapa, 0.0) + duracion
+
+def registrar_tokens(uso):
+    if uso is None: return
+    metricas.contar("vts_openai_tokens_total", uso.prompt_tokens or 0, tipo="prompt")
+    metricas.contar("vts_openai_tokens_total", uso.completion_tokens or 0, tipo="completion")
+
+# ===============================================================
+#  CACHÉ EN MEMORIA (TTL + LRU) ⚡
+# ===============================================================
+class CacheTTL:
+    """Diccionario LRU con expiración por entrada y contadores de aciertos."""
+
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._datos = OrderedDict()  # clave -> (expira_en, valor)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clave):
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None or item[0] < time.monotonic():
+                if item is not None: del self._datos[clave]
+                self.misses += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return item[1]
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + self.ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def agregar_si_nuevo(self, clave, valor=True):
+        """Guarda la clave solo si no existe (o expiró). Devuelve True si era nueva."""
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is not None and item[0] >= time.monotonic():
+                self.hits += 1
+                return False
+            self.misses += 1
+            self._datos[clave] = (time.monotonic() + self.ttl, valor)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+            return True
+
+    def fusionar(self, clave, cambios):
+        """Actualiza campos de un dict cacheado sin contar acierto/fallo."""
+        with self._lock:
+            item = self._datos.get(clave)
+            actual = item[1] if item and item[0] >= time.monotonic() else {}
+        self.set(clave, {**actual, **cambios})
+
+    def borrar(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"items": len(self._datos), "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / total if total else 0.0}
+
+cache_clientes = CacheTTL(CACHE_CLIENTES_MAX, CACHE_CLIENTES_TTL)
+
 # ===============================================================
 #  FUNCIONES (Supabase, OpenAI, Envíos)
 # ===============================================================
+class EscritorMensajes:
+    """Write-behind hacia la tabla `mensajes`: acumula filas y las inserta por lotes.
+
+    Vacía el buffer cuando llega a `lote` filas, cada `intervalo` segundos y
+    al apagar el proceso. Si un insert falla se registra y el lote vuelve al
+    buffer (mientras quepa); el siguiente intento espera `intervalo` segundos,
+    duplicando la espera en cada fallo seguido hasta `MAX_ESPERA`.
+    """
+
+    MAX_ESPERA = 60  # segundos
+
+    def __init__(self, tabla, lote, intervalo, max_buffer):
+        self.tabla = tabla
+        self.lote = lote
+        self.intervalo = intervalo
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._hilo = None
+        self._pid = None
+        self._cerrando = False
+        self._espera_error = 0.0
+        self._reintentar_en = 0.0  # time.monotonic() antes del cual no se reintenta
+
+    def _arrancar(self):
+        if self._pid == os.getpid(): return
+        with self._cond:
+            if self._pid == os.getpid(): return
+            self._hilo = threading.Thread(target=self._bucle, name="escritor-mensajes", daemon=True)
+            self._hilo.start()
+            self._pid = os.getpid()
+
+    def agregar(self, fila):
+        self._arrancar()
+        with self._cond:
+            if len(self._buffer) >= self.max_buffer:
+                print(f"⚠️ Buffer de {self.tabla} lleno, se descarta mensaje de {fila.get('telefono')}")
+                return
+            self._buffer.append(fila)
+            if len(self._buffer) >= self.lote: self._cond.notify()
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                while not self._cerrando:
+                    pausa = self._reintentar_en - time.monotonic()
+                    if pausa > 0:
+                        # En backoff tras un error: se ignora el disparo por tamaño
+                        self._cond.wait(pausa)
+                        continue
+                    if len(self._buffer) >= self.lote: break
+                    if not self._cond.wait(self.intervalo): break
+                if self._cerrando and not self._buffer: return
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            lote, self._buffer = self._buffer[:self.lote], self._buffer[self.lote:]
+        if not lote: return
+        try:
+            with medir("historial_escritura"):
+                supabase.table(self.tabla).insert(lote).execute()
+            metricas.contar("vts_filas_guardadas_total", len(lote), tabla=self.tabla)
+            self._espera_error = 0.0
+        except Exception as e:
+            self._espera_error = min(max(self.intervalo, 2 * self._espera_error), self.MAX_ESPERA)
+            print(f"⚠️ Error insertando {len(lote)} filas en {self.tabla} (reintento en {self._espera_error:.0f}s): {e}")
+            with self._cond:
+                self._reintentar_en = time.monotonic() + self._espera_error
+                if self._cerrando: return
+                cabe = self.max_buffer - len(self._buffer)
+                if cabe < len(lote):
+                    print(f"⚠️ Se descartan {len(lote) - max(cabe, 0)} filas de {self.tabla}")
+                self._buffer[:0] = lote[:max(cabe, 0)]
+
+    def detener(self, timeout=TIMEOUT_DRENADO):
+        if self._pid != os.getpid(): return
+        with self._cond:
+            self._cerrando = True
+            self._cond.notify()
+        self._hilo.join(timeout=max(timeout, 0))
+        if self._hilo.is_alive():
+            print(f"⚠️ Apagado con {len(self._buffer)} filas de {self.tabla} sin guardar")
+
+escritor_mensajes = EscritorMensajes("mensajes", LOTE_MENSAJES, INTERVALO_FLUSH, MAX_BUFFER_MENSAJES)
+
+cache_historial = CacheTTL(CACHE_HISTORIAL_MAX, CACHE_HISTORIAL_TTL)
+
+def _historial(telefono):
+    """Ring buffer con los últimos turnos; se carga de Supabase solo en frío."""
+    turnos = cache_historial.get(telefono)
+    if turnos is None:
+        turnos = deque(maxlen=HISTORIAL_TURNOS)
+        try:
+            with medir("historial_lectura"):
+                resp = supabase.table("mensajes").select("rol, contenido").eq("telefono", telefono).order("created_at", desc=True).limit(HISTORIAL_TURNOS).execute()
+            turnos.extend({"role": m["rol"], "content": m["contenido"]} for m in resp.data[::-1])
+        except Exception as e:
+            # Sin caché: el siguiente mensaje vuelve a intentar la lectura
+            print(f"⚠️ Error leyendo historial de {telefono}: {e}")
+            return turnos
+        cache_historial.set(telefono, turnos)
+    return turnos
+
 def guardar_mensaje(telefono, rol, contenido):
-    try:
-        supabase.table("mensajes").insert({"telefono": telefono, "rol": rol, "contenido": contenido}).execute()
-    except: pass
+    _historial(telefono).append({"role": rol, "content": contenido})
+    # created_at explícito: las filas de un mismo lote no comparten timestamp
+    escritor_mensajes.agregar({"telefono": telefono, "rol": rol, "contenido": contenido,
+                               "created_at": datetime.now(timezone.utc).isoformat()})
 
 def obtener_historial(telefono):
-    try:
-        resp = supabase.table("mensajes").select("rol, contenido").eq("telefono", telefono).order("created_at", desc=True).limit(6).execute()
-        return [{"role": m["rol"], "content": m["contenido"]} for m in resp.data[::-1]]
-    except: return []
+    return list(_historial(telefono))
+
+def normalizar_texto(texto):
+    """Minúsculas, sin acentos, sin signos de puntuación y espacios colapsados."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"[¿?¡!.,;:]+", " ", texto)
+    return " ".join(texto.split())
+
+class CacheRespuestasIA:
+    """Caché de completions: memoria (LRU) y, opcionalmente, SQLite en disco.
+
+    La clave incluye el hash del SYSTEM_PROMPT, así que al cambiar el prompt
+    las respuestas viejas dejan de coincidir (y se purgan de SQLite al arrancar).
+    """
+
+    def __init__(self, system_prompt, max_items, ttl, ruta_sqlite=""):
+        self.hash_prompt = hashlib.sha256(system_prompt.encode()).hexdigest()[:16]
+        self.max_items = max_items
+        self.ttl = ttl
+        self.memoria = CacheTTL(max_items, ttl)
+        self.ruta_sqlite = ruta_sqlite
+        self._local = threading.local()
+        if ruta_sqlite:
+            with self._db() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS respuestas_ia (clave TEXT PRIMARY KEY, respuesta TEXT,"
+                           " hash_prompt TEXT, expira REAL, usado REAL)")
+                db.execute("CREATE INDEX IF NOT EXISTS respuestas_ia_usado ON respuestas_ia (usado)")
+                db.execute("DELETE FROM respuestas_ia WHERE hash_prompt != ? OR expira < ?", (self.hash_prompt, time.time()))
+
+    def _db(self):
+        # sqlite3 no comparte conexiones entre hilos: una por hilo (y por proceso)
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.ruta_sqlite, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def clave(self, modelo, temperatura, historial):
+        turnos = "\x1e".join(f"{m['role']}\x1f{normalizar_texto(m['content'])}" for m in historial)
+        base = f"{modelo}|{temperatura}|{self.hash_prompt}|{turnos}"
+        return hashlib.sha256(base.encode()).hexdigest()
+
+    def get(self, clave):
+        respuesta = self.memoria.get(clave)
+        if respuesta is not None or not self.ruta_sqlite: return respuesta
+        try:
+            db = self._db()
+            fila = db.execute("SELECT respuesta FROM respuestas_ia WHERE clave = ? AND expira >= ?",
+                              (clave, time.time())).fetchone()
+            if fila is None: return None
+            db.execute("UPDATE respuestas_ia SET usado = ? WHERE clave = ?", (time.time(), clave))
+            self.memoria.set(clave, fila[0])
+            return fila[0]
+        except sqlite3.Error as e:
+            print(f"⚠️ Error leyendo caché IA: {e}")
+            return None
+
+    def set(self, clave, respuesta):
+        self.memoria.set(clave, respuesta)
+        if not self.ruta_sqlite: return
+        try:
+            ahora = time.time()
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO respuestas_ia VALUES (?, ?, ?, ?, ?)",
+                       (clave, respuesta, self.hash_prompt, ahora + self.ttl, ahora))
+            # LRU en disco: se eliminan las menos usadas por encima del máximo
+            db.execute("DELETE FROM respuestas_ia WHERE clave IN (SELECT clave FROM respuestas_ia"
+                       " ORDER BY usado DESC LIMIT -1 OFFSET ?)", (self.max_items,))
+        except sqlite3.Error as e:
+            print(f"⚠️ Error guardando caché IA: {e}")
+
+cache_ia = CacheRespuestasIA(SYSTEM_PROMPT, CACHE_IA_MAX, CACHE_IA_TTL, CACHE_IA_SQLITE)
 
 def consultar_chatgpt(historial):
+    clave = cache_ia.clave(MODELO_IA, TEMPERATURA_IA, historial)
+    respuesta = cache_ia.get(clave)
+    if respuesta is not None: return respuesta
     try:
         msgs = [{"role": "system", "content": SYSTEM_PROMPT}] + historial
-        # Temperature 0.5 para balancear creatividad y precisión
-        resp = client_ai.chat.completions.create(model="gpt-4o-mini", messages=msgs, temperature=0.5)
-        return resp.choices[0].message.content
-    except: return "⚠️ Error de conexión neuronal."
+        with medir("llm", modo="simple"):
+            resp = client_ai.chat.completions.create(model=MODELO_IA, messages=msgs, temperature=TEMPERATURA_IA)
+        registrar_tokens(resp.usage)
+        respuesta = resp.choices[0].message.content
+    except Exception as e:
+        print(f"⚠️ Error consultando OpenAI: {e}")
+        return "⚠️ Error de conexión neuronal."
+    if respuesta: cache_ia.set(clave, respuesta)
+    return respuesta
+
+# Estados de paso (esperan la siguiente respuesta del usuario) que no se
+# cachean: el siguiente mensaje puede llegar a otro worker.
+ESTADOS_SIN_CACHE = {"ESPERANDO_NOMBRE"}
 
 def obtener_usuario(telefono):
+    usuario = cache_clientes.get(telefono)
+    if usuario is not None: return dict(usuario)
     try:
-        res = supabase.table("clientes").select("*").eq("telefono", telefono).execute()
-        if res.data: return res.data[0]
-        nuevo = {"telefono": telefono, "estado_flujo": "INICIO"}
-        supabase.table("clientes").insert(nuevo).execute()
-        return nuevo
-    except: return {"telefono": telefono, "estado_flujo": "INICIO"}
+        # Cliente existente: una lectura. Cliente nuevo: un solo upsert que lo
+        # crea ya en INICIO; ignore_duplicates (ON CONFLICT DO NOTHING) evita
+        # pisar la fila si otro worker la creó en el ínterin.
+        # Requiere una restricción UNIQUE (o PK) sobre clientes.telefono.
+        with medir("estado"):
+            res = supabase.table("clientes").select("*").eq("telefono", telefono).execute()
+        if res.data:
+            usuario = res.data[0]
+        else:
+            nuevo = {"telefono": telefono, "estado_flujo": "INICIO"}
+            with medir("estado_escritura"):
+                res = supabase.table("clientes").upsert(nuevo, on_conflict="telefono", ignore_duplicates=True).execute()
+            # Sin filas = otro worker lo creó primero; no se cachea y el siguiente mensaje relee
+            if not res.data: return nuevo
+            usuario = res.data[0]
+        if not usuario.get("estado_flujo"): usuario["estado_flujo"] = "INICIO"
+        if usuario["estado_flujo"] not in ESTADOS_SIN_CACHE: cache_clientes.set(telefono, usuario)
+        return dict(usuario)
+    except Exception as e:
+        print(f"⚠️ Error leyendo cliente {telefono}: {e}")
+        return {"telefono": telefono, "estado_flujo": "INICIO"}
 
 def actualizar_estado(telefono, estado, nombre=None):
+    data = {"estado_flujo": estado}
+    if nombre: data["nombre"] = nombre
     try:
-        data = {"estado_flujo": estado}
-        if nombre: data["nombre"] = nombre
-        supabase.table("clientes").update(data).eq("telefono", telefono).execute()
-    except: pass
+        with medir("estado_escritura"):
+            supabase.table("clientes").update(data).eq("telefono", telefono).execute()
+    except Exception as e:
+        print(f"⚠️ Error actualizando estado de {telefono}: {e}")
+        cache_clientes.borrar(telefono)
+        return
+    # Write-through: la caché refleja lo que acabamos de guardar
+    if estado in ESTADOS_SIN_CACHE: cache_clientes.borrar(telefono)
+    else: cache_clientes.fusionar(telefono, {"telefono": telefono, **data})
 
-# --- FUNCIONES DE ENVÍO DE WHATSAPP ---
-def enviar_mensaje(telefono, texto):
-    url = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-    data = {"messaging_product": "whatsapp", "to": telefono, "type": "text", "text": {"body": texto}}
-    requests.post(url, headers=headers, json=data)
+# ===============================================================
+#  ENVÍOS A WHATSAPP (Pool de conexiones + Rate limit + Reintentos) 📤
+# ===============================================================
+GRAPH_URL = os.environ.get("GRAPH_URL", f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages")
+# El límite de Meta (80 msg/s) es por número emisor y el limitador es por
+# proceso: por defecto se reparte entre los workers de gunicorn. Si se define
+# a mano, MPS_WHATSAPP y RAFAGA_WHATSAPP son por worker.
+MPS_WHATSAPP = float(os.environ.get("MPS_WHATSAPP", 80 / WORKERS_WEB))      # mensajes/seg
+RAFAGA_WHATSAPP = int(os.environ.get("RAFAGA_WHATSAPP", max(80 // WORKERS_WEB, 1)))
+MAX_REINTENTOS = int(os.environ.get("MAX_REINTENTOS", 3))
+# Retry-After más largo que esto (segundos) = se abandona el envío en vez de
+# dejar a un worker del despachador dormido esperando
+MAX_RETRY_AFTER = float(os.environ.get("MAX_RETRY_AFTER", 0.5 * 2 ** MAX_REINTENTOS))
+TIMEOUT_GRAPH = (3.05, 10)                                       # (conexión, lectura)
 
-def enviar_botones(telefono, texto, botones):
-    url = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
+class LimitadorTokens:
+    """Token bucket: permite ráfagas de `capacidad` y `tasa` envíos por segundo."""
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._tokens = float(capacidad)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def tomar(self):
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                espera = (1 - self._tokens) / self.tasa
+            time.sleep(espera)
+
+class EnviadorWhatsApp:
+    """Cliente único hacia la Graph API.
+
+    Reutiliza conexiones keep-alive, respeta el límite de envíos por segundo
+    del número emisor y reintenta 429/5xx y fallos de conexión (antes de
+    enviar) con backoff exponencial + jitter.
+    """
+
+    REINTENTABLES = {429, 500, 502, 503, 504}
+
+    def __init__(self, url, token, tasa, rafaga, max_reintentos, max_paralelo=8):
+        self.url = url
+        self.max_reintentos = max_reintentos
+        self.max_paralelo = max_paralelo
+        self.limitador = LimitadorTokens(tasa, rafaga)
+        self.sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=max(max_paralelo, NUM_WORKERS))
+        self.sesion.mount("https://", adaptador)
+        self.sesion.mount("http://", adaptador)
+        self.sesion.headers.update({"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+        self._pool = None
+        self._pid = None
+
+    def enviar(self, data):
+        """Envía un payload; devuelve el JSON de Meta o None si falló."""
+        tipo = "status" if "status" in data else data.get("type", "otro")
+        with medir("envio", tipo=tipo):
+            resultado = self._enviar(data)
+        if resultado is None: metricas.contar("vts_errores_total", etapa="envio")
+        return resultado
+
+    @staticmethod
+    def _sin_enviar(error):
+        """True si el error ocurrió antes de mandar la petición (no hay riesgo de duplicar)."""
+        if isinstance(error, requests.ConnectTimeout): return True
+        if not isinstance(error, requests.ConnectionError): return False
+        causa = error.args[0] if error.args else None
+        causa = getattr(causa, "reason", causa)  # urllib3 MaxRetryError -> causa real
+        return isinstance(causa, NewConnectionError)
+
+    def _enviar(self, data):
+        for intento in range(self.max_reintentos + 1):
+            self.limitador.tomar()
+            espera = None
+            try:
+                resp = self.sesion.post(self.url, json=data, timeout=TIMEOUT_GRAPH)
+            except requests.RequestException as e:
+                # /messages no es idempotente: si Meta pudo recibir el mensaje
+                # (ej. ReadTimeout) no se reintenta para no mandarlo dos veces
+                if not self._sin_enviar(e):
+                    print(f"⚠️ Envío a {data.get('to')} sin confirmar, no se reintenta: {e}")
+                    return None
+                error = str(e)
+            else:
+                if resp.status_code < 400:
+                    break
+                if resp.status_code not in self.REINTENTABLES:
+                    print(f"⚠️ Graph API {resp.status_code} a {data.get('to')}: {resp.text[:200]}")
+                    return None
+                espera = resp.headers.get("Retry-After")
+                error = f"HTTP {resp.status_code}"
+            if intento == self.max_reintentos:
+                print(f"⚠️ Envío a {data.get('to')} falló tras {self.max_reintentos + 1} intentos: {error}")
+                return None
+            # Full jitter: evita que todos los workers reintenten al mismo tiempo
+            pausa = float(espera) if espera and espera.isdigit() else random.uniform(0, 0.5 * 2 ** intento)
+            if pausa > MAX_RETRY_AFTER:
+                print(f"⚠️ Envío a {data.get('to')} abandonado: Retry-After de {pausa:.0f}s ({error})")
+                return None
+            metricas.contar("vts_envio_reintentos_total")
+            time.sleep(pausa)
+        # Fuera del ciclo de reintentos: el envío ya fue aceptado aunque el cuerpo no sea JSON
+        try:
+            return resp.json()
+        except ValueError:
+            return {}
+
+    def send_many(self, payloads):
+        """Envía una secuencia de payloads y devuelve los resultados en el mismo orden.
+
+        Los mensajes a un mismo destinatario salen en serie para conservar su
+        orden (ej. imagen + botones del saludo); destinatarios distintos se
+        envían en paralelo para que uno lento no frene a los demás.
+        """
+        grupos = {}
+        for i, data in enumerate(payloads):
+            grupos.setdefault(data.get("to"), []).append(i)
+        resultados = [None] * len(payloads)
+
+        def enviar_grupo(indices):
+            for i in indices: resultados[i] = self.enviar(payloads[i])
+
+        if len(grupos) == 1:
+            enviar_grupo(next(iter(grupos.values())))
+        else:
+            list(self._ejecutor().map(enviar_grupo, grupos.values()))
+        return resultados
+
+    def _ejecutor(self):
+        # Un pool por proceso: los hilos no sobreviven al fork de gunicorn
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.max_paralelo, thread_name_prefix="envio")
+            self._pid = os.getpid()
+        return self._pool
+
+enviador = EnviadorWhatsApp(GRAPH_URL, WHATSAPP_TOKEN, MPS_WHATSAPP, RAFAGA_WHATSAPP, MAX_REINTENTOS)
+
+# --- PAYLOADS ---
+def payload_texto(telefono, texto):
+    return {"messaging_product": "whatsapp", "to": telefono, "type": "text", "text": {"body": texto}}
+
+def payload_botones(telefono, texto, botones):
     lista = [{"type": "reply", "reply": {"id": f"btn_{i}", "title": b}} for i, b in enumerate(botones)]
-    data = {
+    return {
         "messaging_product": "whatsapp", "to": telefono, "type": "interactive",
         "interactive": {"type": "button", "body": {"text": texto}, "action": {"buttons": lista}}
     }
-    requests.post(url, headers=headers, json=data)
 
-def enviar_imagen(telefono, link, caption=""):
-    url = f"https://graph.facebook.com/v21.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-    data = {
+def payload_imagen(telefono, link, caption=""):
+    return {
         "messaging_product": "whatsapp", "to": telefono, "type": "image",
         "image": {"link": link, "caption": caption}
     }
-    requests.post(url, headers=headers, json=data)
+
+# --- FUNCIONES DE ENVÍO DE WHATSAPP ---
+def enviar_mensaje(telefono, texto):
+    return enviador.enviar(payload_texto(telefono, texto))
+
+def enviar_botones(telefono, texto, botones):
+    return enviador.enviar(payload_botones(telefono, texto, botones))
+
+def enviar_imagen(telefono, link, caption=""):
+    return enviador.enviar(payload_imagen(telefono, link, caption))
+
+def payload_escribiendo(message_id):
+    # Marca el mensaje como leído y muestra "escribiendo..." (hasta 25 s o el siguiente envío)
+    return {"messaging_product": "whatsapp", "status": "read", "message_id": message_id,
+            "typing_indicator": {"type": "text"}}
+
+def send_many(payloads):
+    return enviador.send_many(payloads)
+
+def mostrar_escribiendo(message_id):
+    if INDICADOR_ESCRIBIENDO and message_id: enviador.enviar(payload_escribiendo(message_id))
+
+# ===============================================================
+#  RESPUESTAS DE LA IA EN STREAMING 💬
+# ===============================================================
+LIMITE_WHATSAPP = 4096  # caracteres por mensaje de texto
+
+class FragmentadorRespuesta:
+    """Parte el texto que va llegando en mensajes de WhatsApp.
+
+    Una vez juntados `min_caracteres`, corta en fin de párrafo (línea en
+    blanco) o, si no hay, en el último salto de línea (ej. entre viñetas),
+    así una respuesta que es solo una lista también sale por partes. Nunca
+    salen más de `max_mensajes`: el último junta lo que falte hasta el límite
+    de WhatsApp y, si no cabe, se trunca con "…" y el resto se descarta.
+    """
+
+    MARCA_TRUNCADO = "\n…"
+
+    def __init__(self, max_mensajes, min_caracteres):
+        self.max_mensajes = max(max_mensajes, 1)
+        self.min_caracteres = min_caracteres
+        self.buffer = ""
+        self.emitidos = 0
+
+    def _corte(self):
+        if self.emitidos >= self.max_mensajes - 1:
+            # Último mensaje: se acumula y solo se corta (truncando) si no cabe
+            if len(self.buffer) <= LIMITE_WHATSAPP: return None
+            limite = LIMITE_WHATSAPP - len(self.MARCA_TRUNCADO)
+            corte = self.buffer.rfind("\n", 0, limite)
+            return corte if corte > 0 else limite
+        corte = self.buffer.find("\n\n", self.min_caracteres)
+        if corte == -1 or corte > LIMITE_WHATSAPP:
+            corte = self.buffer.rfind("\n", self.min_caracteres, LIMITE_WHATSAPP)
+        if corte != -1: return corte
+        if len(self.buffer) > LIMITE_WHATSAPP:
+            corte = self.buffer.rfind("\n", 0, LIMITE_WHATSAPP)
+            return corte if corte > 0 else LIMITE_WHATSAPP
+        return None
+
+    def agregar(self, texto):
+        """Suma un delta del stream y devuelve los bloques que ya están completos."""
+        if self.emitidos >= self.max_mensajes: return []
+        self.buffer += texto
+        bloques = []
+        corte = self._corte()
+        while corte is not None:
+            bloque, self.buffer = self.buffer[:corte].strip(), self.buffer[corte:].lstrip("\n")
+            if self.emitidos >= self.max_mensajes - 1:
+                bloques.append(bloque + self.MARCA_TRUNCADO)
+                self.emitidos, self.buffer = self.max_mensajes, ""
+                print(f"⚠️ Respuesta truncada a {self.max_mensajes} mensajes")
+                break
+            if bloque:
+                bloques.append(bloque)
+                self.emitidos += 1
+            corte = self._corte()
+        return bloques
+
+    def cerrar(self):
+        bloques = self.agregar("")
+        resto, self.buffer = self.buffer.strip(), ""
+        if resto:
+            bloques.append(resto)
+            self.emitidos += 1
+        return bloques
+
+def enviar_en_bloques(numero, texto):
+    fragmentador = FragmentadorRespuesta(MAX_MENSAJES_RESPUESTA, MIN_CARACTERES_BLOQUE)
+    for bloque in fragmentador.agregar(texto) + fragmentador.cerrar(): enviar_mensaje(numero, bloque)
+
+def responder_con_ia(numero, historial, message_id=None):
+    """Consulta a la IA, envía la respuesta al usuario y devuelve el texto completo."""
+    if MODO_RESPUESTA != "stream":
+        resp = consultar_chatgpt(historial)
+        enviar_mensaje(numero, resp)
+        return resp
+
+    clave = cache_ia.clave(MODELO_IA, TEMPERATURA_IA, historial)
+    resp = cache_ia.get(clave)
+    if resp is not None:
+        enviar_en_bloques(numero, resp)
+        return resp
+
+    # Una sola vez antes del stream: repetirlo por bloque cuesta un envío (y
+    # un token del limitador) cada vez y deja "escribiendo…" tras el último
+    mostrar_escribiendo(message_id)
+    fragmentador = FragmentadorRespuesta(MAX_MENSAJES_RESPUESTA, MIN_CARACTERES_BLOQUE)
+    partes = []
+    completa = False
+    inicio = time.perf_counter()
+    try:
+        msgs = [{"role": "system", "content": SYSTEM_PROMPT}] + historial
+        # El span "llm" incluye los envíos intercalados; "envio" los mide aparte
+        with medir("llm", modo="stream"):
+            stream = client_ai.chat.completions.create(model=MODELO_IA, messages=msgs, temperature=TEMPERATURA_IA,
+                                                       stream=True, stream_options={"include_usage": True})
+            for evento in stream:
+                if getattr(evento, "usage", None): registrar_tokens(evento.usage)
+                delta = evento.choices[0].delta.content if evento.choices else None
+                if not delta: continue
+                if not partes: metricas.observar("vts_llm_primer_token_segundos", time.perf_counter() - inicio)
+                partes.append(delta)
+                for bloque in fragmentador.agregar(delta): enviar_mensaje(numero, bloque)
+        completa = True
+    except Exception as e:
+        print(f"⚠️ Error en streaming de OpenAI: {e}")
+        if not partes:
+            # No salió nada todavía: reintentamos en modo de un solo mensaje
+            resp = consultar_chatgpt(historial)
+            enviar_mensaje(numero, resp)
+            return resp
+
+    for bloque in fragmentador.cerrar(): enviar_mensaje(numero, bloque)
+    resp = "".join(partes)
+    if not resp:
+        resp = "⚠️ Error de conexión neuronal."
+        enviar_mensaje(numero, resp)
+    elif completa:
+        cache_ia.set(clave, resp)
+    return resp
+
+# ===============================================================
+#  DETECTOR DE INTENCIONES (Palabras clave + TF-IDF) 🔎
+# ===============================================================
+class DetectorIntenciones:
+    """Clasifica un texto contra INTENCIONES sin salir del proceso.
+
+    Se compila una sola vez: un índice de palabras clave normalizadas y un
+    índice invertido TF-IDF de trigramas de letras sobre los ejemplos. Una
+    intención solo es candidata si el texto tiene alguna de sus palabras
+    clave y no trae palabras de contenido que la intención no cubre (ej.
+    "el precio incluye IVA?"); su confianza mezcla la palabra clave con la
+    similitud al ejemplo más parecido, y ninguna de las dos alcanza el umbral
+    por sí sola. Textos largos, negaciones o empates se dejan a la IA.
+    """
+
+    PESO_PALABRA = 0.4
+    MARGEN_EMPATE = 0.1
+    # Palabras que no cambian el sentido de la pregunta; cualquier otra que la
+    # intención no tenga en sus palabras clave o ejemplos manda el texto a la IA
+    VACIAS = set("""a al como con cual cuales de del el en es esta este ese eso hay la las le les lo los me mi
+        mis nos o para por pues que se si su sus tu tus un una unos unas usted ustedes y ya ok oye
+        buenas buenos dias tardes noches porfa favor quisiera saber podria puede pueden""".split())
+    NEGACIONES = {"no", "ni", "nunca", "tampoco", "sin"}
+
+    def __init__(self, intenciones, umbral, max_palabras):
+        self.intenciones = intenciones
+        self.umbral = umbral
+        self.max_palabras = max_palabras
+        self.palabras = {}  # frase normalizada -> índices de intención
+        for i, intencion in enumerate(intenciones):
+            for palabra in intencion.get("palabras", []):
+                self.palabras.setdefault(normalizar_texto(palabra), set()).add(i)
+        self.frase_max = max((len(p.split()) for p in self.palabras), default=1)
+        # Vocabulario que cubre cada intención (palabras clave + ejemplos)
+        self.vocabulario = [{t for frase in intencion.get("palabras", []) + intencion.get("ejemplos", [])
+                             for t in normalizar_texto(frase).split()} for intencion in intenciones]
+
+        docs = [(i, self._ngramas(normalizar_texto(ej))) for i, intencion in enumerate(intenciones)
+                for ej in intencion.get("ejemplos", [])]
+        df = {}
+        for _, grams in docs:
+            for g in grams: df[g] = df.get(g, 0) + 1
+        self.idf = {g: math.log((1 + len(docs)) / (1 + n)) + 1 for g, n in df.items()}
+        self.idf_desconocido = math.log(1 + len(docs)) + 1
+        self.indice = {}    # trigrama -> [(doc, peso)]
+        self.doc_intencion = []
+        for d, (i, grams) in enumerate(docs):
+            vector = self._vector(grams)
+            for g, peso in vector.items(): self.indice.setdefault(g, []).append((d, peso))
+            self.doc_intencion.append(i)
+
+    @staticmethod
+    def _ngramas(texto, n=3):
+        texto = f" {texto} "
+        grams = {}
+        for k in range(len(texto) - n + 1):
+            g = texto[k:k + n]
+            grams[g] = grams.get(g, 0) + 1
+        return grams
+
+    def _vector(self, grams):
+        vector = {g: c * self.idf.get(g, self.idf_desconocido) for g, c in grams.items()}
+        norma = math.sqrt(sum(p * p for p in vector.values())) or 1.0
+        return {g: p / norma for g, p in vector.items()}
+
+    def puntajes(self, texto):
+        """Confianza (0-1) por índice de intención candidata."""
+        norm = normalizar_texto(texto)
+        tokens = norm.split()
+        if self.NEGACIONES.intersection(tokens): return {}
+        # Palabras clave: n-gramas de palabras del texto contra el índice
+        candidatas = set()
+        for n in range(1, self.frase_max + 1):
+            for k in range(len(tokens) - n + 1):
+                candidatas.update(self.palabras.get(" ".join(tokens[k:k + n]), ()))
+        contenido = set(tokens) - self.VACIAS
+        candidatas = {i for i in candidatas if contenido <= self.vocabulario[i]}
+        if not candidatas: return {}
+        # Similitud coseno contra el ejemplo más parecido de cada intención
+        puntajes = {}
+        for g, peso in self._vector(self._ngramas(norm)).items():
+            for d, peso_doc in self.indice.get(g, ()):
+                puntajes[d] = puntajes.get(d, 0.0) + peso * peso_doc
+        similitud = {}
+        for d, valor in puntajes.items():
+            i = self.doc_intencion[d]
+            if i in candidatas: similitud[i] = max(similitud.get(i, 0.0), valor)
+        return {i: self.PESO_PALABRA + (1 - self.PESO_PALABRA) * min(similitud.get(i, 0.0), 1.0)
+                for i in candidatas}
+
+    def verificar(self, casos):
+        """Compara contra (frase, intención esperada o None); devuelve los que no coinciden."""
+        fallos = []
+        for frase, esperada in casos:
+            obtenida = self.detectar(frase)
+            obtenida = obtenida["nombre"] if obtenida else None
+            if obtenida != esperada: fallos.append((frase, esperada, obtenida))
+        return fallos
+
+    def detectar(self, texto):
+        """Devuelve la intención ganadora o None si no hay suficiente confianza."""
+        if len(texto.split()) > self.max_palabras: return None
+        lineas = [l for l in texto.splitlines() if l.strip()]
+        if len(lineas) > 1:
+            # Ráfaga unida: solo se contesta local si todas las líneas piden lo mismo
+            intenciones = [self.detectar(l) for l in lineas]
+            return intenciones[0] if all(i is not None and i is intenciones[0] for i in intenciones) else None
+        ranking = sorted(self.puntajes(texto).items(), key=lambda x: x[1], reverse=True)
+        if not ranking or ranking[0][1] < self.umbral: return None
+        if len(ranking) > 1 and ranking[0][1] - ranking[1][1] < self.MARGEN_EMPATE: return None
+        return self.intenciones[ranking[0][0]]
+
+detector_intenciones = DetectorIntenciones(INTENCIONES, UMBRAL_INTENCION, MAX_PALABRAS_INTENCION)
+for _frase, _esperada, _obtenida in detector_intenciones.verificar(CASOS_INTENCIONES):
+    print(f"⚠️ Intención para '{_frase}': se esperaba {_esperada}, se obtuvo {_obtenida}")
+
+# ===============================================================
+#  LÓGICA DEL BOT (Se ejecuta en segundo plano) 🧠
+# ===============================================================
+def es_saludo(texto_lower):
+    return "hola" in texto_lower or "inicio" in texto_lower or "menu" in texto_lower or "menú" in texto_lower
+
+def es_texto_libre(numero, msg, recibido=None):
+    return msg["type"] == "text" and not es_saludo(msg["text"]["body"].lower())
+
+def juntar_rafaga(numero, texto):
+    """Une en un solo turno los textos que el usuario mandó seguidos.
+
+    Toma de la fila del número los textos libres que ya esperan detrás de
+    este. Solo si había alguno (ráfaga en curso) espera hasta VENTANA_RAFAGA
+    desde el último en llegar por si vienen más, con un tope total de 4
+    ventanas; así un mensaje suelto no retiene al worker.
+    """
+    if MODO_DESPACHO == "sync": return texto
+    siguientes = despachador.extraer_siguientes(numero, es_texto_libre)
+    limite = time.monotonic() + 4 * VENTANA_RAFAGA
+    while siguientes and VENTANA_RAFAGA > 0:
+        ultimo = siguientes[-1][2] or time.monotonic()
+        pausa = min(ultimo + VENTANA_RAFAGA, limite) - time.monotonic()
+        if pausa <= 0: break
+        time.sleep(pausa)
+        nuevos = despachador.extraer_siguientes(numero, es_texto_libre)
+        if not nuevos: break
+        siguientes += nuevos
+    if not siguientes: return texto
+    print(f"🧩 {numero}: {len(siguientes) + 1} mensajes unidos en un turno")
+    metricas.contar("vts_mensajes_unidos_total", len(siguientes))
+    return "\n".join([texto] + [msg["text"]["body"] for _, msg, _ in siguientes])
+
+def procesar_mensaje(numero, msg):
+    usuario = obtener_usuario(numero)
+    estado = usuario.get("estado_flujo", "INICIO")
+
+    # Detectar contenido
+    texto = ""
+    es_boton = False
+    if msg["type"] == "text": texto = msg["text"]["body"]
+    elif msg["type"] == "interactive": 
+        texto = msg["interactive"]["button_reply"]["title"]
+        es_boton = True
+
+    print(f"📩 {numero}: {texto}")
+    texto_lower = texto.lower()
+
+    # --- LÓGICA HÍBRIDA (MENU + IMÁGENES + IA) ---
+
+    # 1. SI ES UN SALUDO -> Mandamos Imagen + Menú (Punto 1)
+    if es_saludo(texto_lower):
+        send_many([
+            # Primero la imagen (Promoción Mercantil)
+            payload_imagen(numero, URL_IMAGEN_PROMO, "🚀 *Bienvenido a Verified Tech Solutions*"),
+            # Luego los botones
+            payload_botones(numero, "Selecciona una opción o escribe tu duda directamente:", ["💰 Ver Precios", "📅 Agendar Cita", "🤖 Sobre Nosotros"]),
+        ])
+        return
+
+    # 2. CAPTURA DE DATOS (Nombre)
+    if estado == 'ESPERANDO_NOMBRE':
+        actualizar_estado(numero, 'INICIO', nombre=texto)
+        enviar_botones(numero, f"Gracias {texto}. ¿Cómo procedemos?", ["💰 Ver Precios", "📅 Agendar Cita"])
+        return
+
+    # 3. BOTONES ESPECÍFICOS
+    if es_boton:
+        if "Precios" in texto:
+            # Aquí la IA ya sabe los precios, pero podemos forzar un formato bonito
+            enviar_mensaje(numero, TEXTO_PRECIOS)
+        elif "Agendar" in texto:
+            actualizar_estado(numero, 'ESPERANDO_NOMBRE')
+            enviar_mensaje(numero, "📝 Para coordinar la reunión, por favor escribe tu **nombre completo**:")
+        elif "Sobre Nosotros" in texto:
+            # Dejamos que la IA responda esto con su System Prompt
+            historial = obtener_historial(numero)
+            responder_con_ia(numero, historial, msg.get("id"))
+        
+        guardar_mensaje(numero, "user", f"[Botón: {texto}]")
+
+    # 4. INTELIGENCIA ARTIFICIAL (Para todo lo demás)
+    else:
+        texto = juntar_rafaga(numero, texto)
+        guardar_mensaje(numero, "user", texto)
+        with medir("intencion"):
+            intencion = detector_intenciones.detectar(texto)
+        if intencion:
+            metricas.contar("vts_respuestas_locales_total", intencion=intencion["nombre"])
+            print(f"🎯 {numero}: respuesta local '{intencion['nombre']}'")
+            if intencion.get("botones"): enviar_botones(numero, intencion["respuesta"], intencion["botones"])
+            else: enviar_mensaje(numero, intencion["respuesta"])
+            guardar_mensaje(numero, "assistant", intencion["respuesta"])
+            return
+        historial = obtener_historial(numero)
+        resp = responder_con_ia(numero, historial, msg.get("id"))
+        guardar_mensaje(numero, "assistant", resp)
+
+def atender_mensaje(numero, msg, recibido=None):
+    """Envuelve procesar_mensaje con métricas y el log de mensajes lentos."""
+    inicio = time.perf_counter()
+    if recibido is not None: metricas.observar("vts_cola_espera_segundos", time.monotonic() - recibido)
+    metricas.ajustar("vts_mensajes_en_proceso", 1)
+    _traza.etapas = {}
+    try:
+        procesar_mensaje(numero, msg)
+    except Exception:
+        metricas.contar("vts_errores_total", etapa="procesar")
+        raise
+    finally:
+        duracion = time.perf_counter() - inicio
+        metricas.ajustar("vts_mensajes_en_proceso", -1)
+        metricas.observar("vts_mensaje_segundos", duracion)
+        etapas, _traza.etapas = _traza.etapas, None
+        if duracion >= UMBRAL_LENTO:
+            desglose = ", ".join(f"{e} {s:.2f}s" for e, s in sorted(etapas.items(), key=lambda x: -x[1]))
+            print(f"🐢 {numero}: {duracion:.2f}s ({desglose or 'sin etapas medidas'})")
+
+# ===============================================================
+#  DESPACHO EN SEGUNDO PLANO (Cola + Workers) ⚙️
+# ===============================================================
+class Despachador:
+    """Pool de hilos que respeta el orden de llegada por número de teléfono.
+
+    Cada número tiene su propia fila; un solo worker la atiende a la vez,
+    así que los mensajes de un mismo cliente nunca se procesan en paralelo
+    ni fuera de orden, pero clientes distintos no se bloquean entre sí.
+    """
+
+    def __init__(self, manejador, num_workers, max_pendientes):
+        self.manejador = manejador
+        self.num_workers = num_workers
+        self._cupos = threading.BoundedSemaphore(max_pendientes)
+        self._lock = threading.Lock()
+        self._vacio = threading.Condition(self._lock)
+        self._filas = {}              # numero -> deque de trabajos pendientes
+        self._listos = queue.Queue()  # números con trabajo esperando un worker
+        self._hilos = []
+        self._pid = None
+        self._cerrando = False
+
+    def _arrancar(self):
+        # Arranque perezoso: gunicorn hace fork después de importar app.py
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._hilos = [threading.Thread(target=self._bucle, name=f"despacho-{i}", daemon=True)
+                           for i in range(self.num_workers)]
+            for hilo in self._hilos: hilo.start()
+            self._pid = os.getpid()
+
+    def encolar(self, numero, *args):
+        """Devuelve False si estamos saturados o apagando (backpressure)."""
+        if self._cerrando: return False
+        self._arrancar()
+        if not self._cupos.acquire(timeout=TIMEOUT_ENCOLAR): return False
+        with self._lock:
+            fila = self._filas.get(numero)
+            if fila is None:
+                self._filas[numero] = deque([args])
+                self._listos.put(numero)
+            else:
+                fila.append(args)
+        return True
+
+    def extraer_siguientes(self, numero, predicado):
+        """Saca de la fila de `numero` los trabajos contiguos que cumplan `predicado`.
+
+        Lo llama el worker que atiende a ese número para fusionar trabajos.
+        """
+        tomados = []
+        with self._lock:
+            fila = self._filas.get(numero)
+            while fila and predicado(*fila[0]):
+                tomados.append(fila.popleft())
+        for _ in tomados: self._cupos.release()
+        return tomados
+
+    def pendientes(self):
+        with self._lock:
+            return sum(len(f) for f in self._filas.values())
+
+    def _bucle(self):
+        while True:
+            numero = self._listos.get()
+            if numero is None: return
+            with self._lock:
+                args = self._filas[numero].popleft()
+            try:
+                self.manejador(*args)
+            except Exception as e:
+                print(f"Error procesando {numero}: {e}")
+            finally:
+                self._cupos.release()
+                with self._lock:
+                    if self._filas[numero]:
+                        self._listos.put(numero)
+                    else:
+                        del self._filas[numero]
+                        if not self._filas: self._vacio.notify_all()
+
+    def detener(self, timeout=TIMEOUT_DRENADO):
+        """Deja de aceptar trabajo y espera a que se vacíen las filas."""
+        self._cerrando = True
+        if self._pid != os.getpid(): return
+        limite = time.monotonic() + timeout
+        with self._lock:
+            drenado = self._vacio.wait_for(lambda: not self._filas, timeout)
+        if not drenado:
+            print(f"⚠️ Apagado con {self.pendientes()} mensajes sin procesar")
+        for _ in self._hilos: self._listos.put(None)
+        for hilo in self._hilos: hilo.join(timeout=max(limite - time.monotonic(), 0))
+
+despachador = Despachador(atender_mensaje, NUM_WORKERS, MAX_PENDIENTES)
+
+def apagar():
+    """Vacía la cola y luego el buffer de mensajes, todo dentro de TIMEOUT_DRENADO."""
+    limite = time.monotonic() + TIMEOUT_DRENADO
+    # El despachador va primero (sus workers generan filas) y deja una reserva
+    # para que el escritor alcance a guardarlas antes del SIGKILL
+    despachador.detener(timeout=TIMEOUT_DRENADO * 0.8)
+    escritor_mensajes.detener(timeout=limite - time.monotonic())
+
+atexit.register(apagar)
+
+# ===============================================================
+#  ENTRADA: NORMALIZACIÓN Y DEDUPLICACIÓN 📥
+# ===============================================================
+ids_vistos = CacheTTL(DEDUP_MAX, DEDUP_TTL)
+
+def normalizar_numero(numero):
+    if numero.startswith("521"): numero = numero.replace("521", "52", 1)
+    return numero
+
+def extraer_mensajes(body):
+    """Recorre todas las entries, changes y messages de una entrega de Meta."""
+    for entry in body.get("entry", []):
+        for change in entry.get("changes", []):
+            for msg in change.get("value", {}).get("messages", []):
+                yield msg
+
+def filtrar_nuevos(msgs):
+    """Descarta los wamid ya procesados (reintentos de Meta)."""
+    nuevos = [m for m in msgs if ids_vistos.agregar_si_nuevo(m["id"])]
+    if not DEDUP_SUPABASE or not nuevos: return nuevos
+    try:
+        # ignore_duplicates: Supabase solo devuelve las filas que sí insertó
+        with medir("dedup"):
+            res = supabase.table("webhook_eventos").upsert([{"wamid": m["id"]} for m in nuevos],
+                                                          on_conflict="wamid", ignore_duplicates=True).execute()
+        insertados = {fila["wamid"] for fila in res.data}
+        return [m for m in nuevos if m["id"] in insertados]
+    except Exception as e:
+        print(f"⚠️ Error deduplicando en Supabase: {e}")
+        return nuevos
+
+def olvidar_ids(msgs):
+    """Permite que Meta vuelva a entregar mensajes que no pudimos encolar."""
+    for m in msgs: ids_vistos.borrar(m["id"])
+    if not DEDUP_SUPABASE or not msgs: return
+    try:
+        supabase.table("webhook_eventos").delete().in_("wamid", [m["id"] for m in msgs]).execute()
+    except Exception as e:
+        print(f"⚠️ Error liberando wamids en Supabase: {e}")
 
 # ===============================================================
 #  WEBHOOK PRINCIPAL
@@ -126,73 +1318,50 @@ def verificar():
 
 @app.route('/webhook', methods=['POST'])
 def recibir():
+    with medir("webhook"):
+        return _recibir()
+
+def _recibir():
     body = request.get_json()
     try:
         if body.get("object"):
-            entry = body["entry"][0]["changes"][0]["value"]
-            if "messages" in entry:
-                msg = entry["messages"][0]
-                numero = msg["from"]
-                if numero.startswith("521"): numero = numero.replace("521", "52", 1)
-
-                usuario = obtener_usuario(numero)
-                estado = usuario.get("estado_flujo", "INICIO")
-
-                # Detectar contenido
-                texto = ""
-                es_boton = False
-                if msg["type"] == "text": texto = msg["text"]["body"]
-                elif msg["type"] == "interactive": 
-                    texto = msg["interactive"]["button_reply"]["title"]
-                    es_boton = True
-
-                print(f"📩 {numero}: {texto}")
-                texto_lower = texto.lower()
-
-                # --- LÓGICA HÍBRIDA (MENU + IMÁGENES + IA) ---
-
-                # 1. SI ES UN SALUDO -> Mandamos Imagen + Menú (Punto 1)
-                if "hola" in texto_lower or "inicio" in texto_lower or "menu" in texto_lower or "menú" in texto_lower:
-                    # Primero la imagen (Promoción Mercantil)
-                    enviar_imagen(numero, URL_IMAGEN_PROMO, "🚀 *Bienvenido a Verified Tech Solutions*")
-                    # Luego los botones
-                    enviar_botones(numero, "Selecciona una opción o escribe tu duda directamente:", ["💰 Ver Precios", "📅 Agendar Cita", "🤖 Sobre Nosotros"])
-                    return "OK", 200
-
-                # 2. CAPTURA DE DATOS (Nombre)
-                if estado == 'ESPERANDO_NOMBRE':
-                    actualizar_estado(numero, 'INICIO', nombre=texto)
-                    enviar_botones(numero, f"Gracias {texto}. ¿Cómo procedemos?", ["💰 Ver Precios", "📅 Agendar Cita"])
-                    return "OK", 200
-
-                # 3. BOTONES ESPECÍFICOS
-                if es_boton:
-                    if "Precios" in texto:
-                        # Aquí la IA ya sabe los precios, pero podemos forzar un formato bonito
-                        enviar_mensaje(numero, "💰 **Plan Inicial VTS:**\n\n- **$4,500 MXN/mes**\n- Atención 24/7\n- Infraestructura incluida\n\n¿Te interesa una demo?")
-                    elif "Agendar" in texto:
-                        actualizar_estado(numero, 'ESPERANDO_NOMBRE')
-                        enviar_mensaje(numero, "📝 Para coordinar la reunión, por favor escribe tu **nombre completo**:")
-                    elif "Sobre Nosotros" in texto:
-                        # Dejamos que la IA responda esto con su System Prompt
-                        historial = obtener_historial(numero)
-                        resp = consultar_chatgpt(historial)
-                        enviar_mensaje(numero, resp)
-                    
-                    guardar_mensaje(numero, "user", f"[Botón: {texto}]")
-
-                # 4. INTELIGENCIA ARTIFICIAL (Para todo lo demás)
-                else:
-                    guardar_mensaje(numero, "user", texto)
-                    historial = obtener_historial(numero)
-                    resp = consultar_chatgpt(historial)
-                    enviar_mensaje(numero, resp)
-                    guardar_mensaje(numero, "assistant", resp)
+            todos = list(extraer_mensajes(body))
+            msgs = filtrar_nuevos(todos)
+            metricas.contar("vts_mensajes_recibidos_total", len(todos))
+            metricas.contar("vts_duplicados_total", len(todos) - len(msgs))
+            recibido = time.monotonic()
+            for i, msg in enumerate(msgs):
+                numero = normalizar_numero(msg["from"])
+                if MODO_DESPACHO == "sync":
+                    atender_mensaje(numero, msg)
+                elif not despachador.encolar(numero, numero, msg, recibido):
+                    # Saturados: Meta reintentará la entrega más tarde
+                    metricas.contar("vts_rechazados_total", len(msgs) - i)
+                    olvidar_ids(msgs[i:])
+                    return "BUSY", 503
 
             return "EVENT_RECEIVED", 200
     except Exception as e:
         print(f"Error: {e}")
         return "EVENT_RECEIVED", 200
 
+# ===============================================================
+#  MÉTRICAS (Prometheus)
+# ===============================================================
+@metricas.recolector
+def _metricas_internas():
+    datos = [("gauge", "vts_cola_pendientes", {}, despachador.pendientes())]
+    for nombre, cache in (("clientes", cache_clientes), ("historial", cache_historial),
+                          ("respuestas_ia", cache_ia.memoria), ("dedup", ids_vistos)):
+        stats = cache.estadisticas()
+        datos.append(("gauge", "vts_cache_items", {"cache": nombre}, stats["items"]))
+        datos.append(("counter", "vts_cache_aciertos_total", {"cache": nombre}, stats["hits"]))
+        datos.append(("counter", "vts_cache_fallos_total", {"cache": nombre}, stats["misses"]))
+    return datos
+
+@app.route('/metrics', methods=['GET'])
+def exportar_metricas():
+    return Response(metricas.exportar(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 3000)))
\ No newline at end of file
@@ -0,0 +1,329 @@
+"""Prueba de carga offline del bot.
+
+Levanta los stubs de Graph API, Supabase y OpenAI (ver stubs.py), arranca
+app.py con gunicorn apuntando a ellos y simula conversaciones concurrentes:
+saludos, botones, preguntas frecuentes, texto libre, entregas en lote y
+entregas duplicadas. Al final imprime y guarda en benchmark/resultados/:
+
+- throughput (mensajes/seg)
+- latencia del ACK del webhook (p50/p95/p99), medida por gunicorn en su
+  access log: los stubs y los hilos de carga comparten proceso con este
+  script y medir desde el cliente reporta sobre todo su propio GIL
+- latencia de punta a punta hasta el primer envío a Graph (p50/p95/p99)
+- llamadas a cada backend por mensaje y respuestas duplicadas
+
+Uso (desde la raíz del repo):
+
+    python -m benchmark.carga --conversaciones 50 --mensajes 10
+    python -m benchmark.carga --env VENTANA_RAFAGA=0 --comparar benchmark/resultados/base.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from .stubs import StubGraph, StubOpenAI, StubSupabase
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIR_RESULTADOS = os.path.join(RAIZ, "benchmark", "resultados")
+
+# Tipos de paso y su peso en la mezcla de tráfico
+MEZCLA = {"saludo": 2, "boton": 2, "faq": 3, "libre": 4, "lote": 1, "duplicado": 1}
+PREGUNTAS_FAQ = ["¿Cuánto cuesta?", "cual es su horario", "que venden?", "gracias!"]
+PREGUNTAS_LIBRES = ["¿Se puede integrar con mi CRM?", "¿Cuánto tarda la implementación?",
+                    "¿Funciona para una clínica dental?", "¿Qué pasa si un cliente pide hablar con un humano?"]
+BOTONES = ["💰 Ver Precios", "🤖 Sobre Nosotros"]
+
+# Métricas comparables entre corridas: True = mayor es mejor
+METRICAS = {
+    "throughput_msgs_seg": True,
+    "ack_ms.p50": False, "ack_ms.p95": False, "ack_ms.p99": False,
+    "respuesta_ms.p50": False, "respuesta_ms.p95": False, "respuesta_ms.p99": False,
+    "llamadas_por_mensaje.graph": False, "llamadas_por_mensaje.supabase": False,
+    "llamadas_por_mensaje.openai": False,
+}
+
+
+# ===============================================================
+#  PAYLOADS DE WEBHOOK
+# ===============================================================
+def mensaje_texto(numero, texto):
+    return {"from": numero, "id": f"wamid.bench{time.time_ns()}{random.randint(0, 9999)}",
+            "timestamp": str(int(time.time())), "type": "text", "text": {"body": texto}}
+
+
+def mensaje_boton(numero, titulo):
+    return {"from": numero, "id": f"wamid.bench{time.time_ns()}{random.randint(0, 9999)}",
+            "timestamp": str(int(time.time())), "type": "interactive",
+            "interactive": {"type": "button_reply", "button_reply": {"id": "btn_0", "title": titulo}}}
+
+
+def entrega(*mensajes):
+    """Cuerpo de webhook como lo manda Meta; todos los mensajes en una sola entrega."""
+    return {"object": "whatsapp_business_account", "entry": [{"id": "bench", "changes": [{
+        "field": "messages", "value": {"messaging_product": "whatsapp",
+                                       "metadata": {"phone_number_id": "bench"},
+                                       "messages": list(mensajes)}}]}]}
+
+
+def paso(tipo, numero, n):
+    if tipo == "saludo": return [entrega(mensaje_texto(numero, "Hola"))]
+    if tipo == "boton": return [entrega(mensaje_boton(numero, random.choice(BOTONES)))]
+    if tipo == "faq": return [entrega(mensaje_texto(numero, random.choice(PREGUNTAS_FAQ)))]
+    if tipo == "libre": return [entrega(mensaje_texto(numero, f"{random.choice(PREGUNTAS_LIBRES)} ({n})"))]
+    if tipo == "lote":
+        return [entrega(mensaje_texto(numero, "Tengo una pregunta"),
+                        mensaje_texto(numero, f"{random.choice(PREGUNTAS_LIBRES)} ({n})"))]
+    # duplicado: Meta reintenta la misma entrega; debe responderse una sola vez
+    cuerpo = entrega(mensaje_texto(numero, "¿Cuánto cuesta?"))
+    return [cuerpo, cuerpo]
+
+
+# ===============================================================
+#  ENTORNO (stubs + gunicorn)
+# ===============================================================
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def arrancar_app(args, graph, supa, ia, access_log):
+    puerto = puerto_libre()
+    env = dict(os.environ,
+               VERIFY_TOKEN="bench", WHATSAPP_TOKEN="bench", PHONE_NUMBER_ID="bench",
+               GRAPH_URL=f"{graph.url}/v21.0/bench/messages",
+               SUPABASE_URL=supa.url, SUPABASE_KEY="bench" * 8,
+               OPENAI_API_KEY="sk-bench", OPENAI_BASE_URL=f"{ia.url}/v1",
+               WEB_CONCURRENCY=str(args.workers))
+    for par in args.env:
+        clave, _, valor = par.partition("=")
+        env[clave] = valor
+    cmd = [sys.executable, "-m", "gunicorn", "app:app", "-b", f"127.0.0.1:{puerto}",
+           "-w", str(args.workers), "--log-level", "warning",
+           # %(D)s: microsegundos que el worker tardó en contestar la petición
+           "--access-logfile", access_log, "--access-logformat", "%(m)s %(U)s %(s)s %(D)s"]
+    salida = None if args.verbose else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, cwd=RAIZ, env=env, stdout=salida, stderr=salida)
+    url = f"http://127.0.0.1:{puerto}/webhook"
+    verificacion = {"hub.mode": "subscribe", "hub.verify_token": "bench", "hub.challenge": "ok"}
+    limite = time.time() + 30
+    while time.time() < limite:
+        if proc.poll() is not None: sys.exit("❌ gunicorn terminó al arrancar (usa --verbose)")
+        try:
+            if requests.get(url, params=verificacion, timeout=1).text == "ok": return proc, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    sys.exit("❌ gunicorn no respondió en 30 s")
+
+
+# ===============================================================
+#  SIMULACIÓN
+# ===============================================================
+class Registro:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.respuesta_ms = []
+        self.mensajes = 0
+        self.rechazados = 0
+        self.sin_respuesta = 0
+        self.duplicados_respondidos = 0
+
+    def sumar(self, **campos):
+        with self.lock:
+            for campo, valor in campos.items():
+                actual = getattr(self, campo)
+                if isinstance(actual, list): actual.append(valor)
+                else: setattr(self, campo, actual + valor)
+
+
+def esperar_quietud(graph, numero, pausa, maximo):
+    """Espera a que dejen de llegar envíos a `numero` (ej. bloques del streaming)."""
+    limite = time.time() + maximo
+    total = graph.total_envios(numero)
+    while time.time() < limite:
+        time.sleep(pausa)
+        nuevo = graph.total_envios(numero)
+        if nuevo == total: return nuevo
+        total = nuevo
+    return total
+
+
+def conversacion(i, args, url, graph, registro):
+    numero = f"5255{i:08d}"
+    sesion = requests.Session()
+    tipos, pesos = list(MEZCLA), list(MEZCLA.values())
+    for n in range(args.mensajes):
+        tipo = "saludo" if n == 0 else random.choices(tipos, pesos)[0]
+        cuerpos = paso(tipo, numero, n)
+        antes = graph.total_envios(numero)
+        t0 = time.time()
+        for cuerpo in cuerpos:
+            try:
+                codigo = sesion.post(url, json=cuerpo, timeout=30).status_code
+            except requests.RequestException:
+                codigo = None
+            if codigo != 200: registro.sumar(rechazados=1)
+        registro.sumar(mensajes=sum(len(c["entry"][0]["changes"][0]["value"]["messages"]) for c in cuerpos[:1]))
+
+        ts = graph.esperar_envio(numero, t0, args.timeout_respuesta)
+        if ts is None:
+            registro.sumar(sin_respuesta=1)
+            continue
+        registro.sumar(respuesta_ms=(ts - t0) * 1000)
+        despues = esperar_quietud(graph, numero, args.pausa, args.timeout_respuesta)
+        if tipo == "duplicado" and despues - antes > 1: registro.sumar(duplicados_respondidos=1)
+
+
+def percentiles(valores):
+    if not valores: return {"p50": None, "p95": None, "p99": None}
+    orden = sorted(valores)
+    def p(q): return round(orden[min(len(orden) - 1, int(q / 100 * len(orden)))], 2)
+    return {"p50": p(50), "p95": p(95), "p99": p(99)}
+
+
+def leer_acks(access_log):
+    """Milisegundos de cada POST /webhook según el access log de gunicorn."""
+    acks = []
+    with open(access_log, encoding="utf-8") as f:
+        for linea in f:
+            partes = linea.split()
+            if len(partes) == 4 and partes[:2] == ["POST", "/webhook"]:
+                acks.append(int(partes[3]) / 1000)
+    return acks
+
+
+def por_mensaje(stub, mensajes):
+    return round(sum(stub.llamadas.values()) / mensajes, 3) if mensajes else None
+
+
+def correr(args):
+    graph = StubGraph(latencia=args.latencia_graph, jitter=args.latencia_graph / 2, tasa_error=args.error_graph).iniciar()
+    supa = StubSupabase(latencia=args.latencia_supabase, jitter=args.latencia_supabase / 2,
+                        tasa_error=args.error_supabase).iniciar()
+    ia = StubOpenAI(latencia=args.latencia_openai, jitter=args.latencia_openai / 4, tasa_error=args.error_openai).iniciar()
+    fd, access_log = tempfile.mkstemp(prefix="vts-access-", suffix=".log")
+    os.close(fd)
+    proc, url = arrancar_app(args, graph, supa, ia, access_log)
+    for stub in (graph, supa, ia): stub.reiniciar_contadores()
+
+    registro = Registro()
+    inicio = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=args.conversaciones) as pool:
+            list(pool.map(lambda i: conversacion(i, args, url, graph, registro), range(args.conversaciones)))
+    finally:
+        duracion = time.time() - inicio
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        for stub in (graph, supa, ia): stub.detener()
+    acks = leer_acks(access_log)
+    os.remove(access_log)
+
+    return {
+        "mensajes": registro.mensajes,
+        "duracion_seg": round(duracion, 2),
+        "throughput_msgs_seg": round(registro.mensajes / duracion, 2),
+        "ack_ms": percentiles(acks),
+        "respuesta_ms": percentiles(registro.respuesta_ms),
+        "rechazados_503": registro.rechazados,
+        "sin_respuesta": registro.sin_respuesta,
+        "duplicados_respondidos": registro.duplicados_respondidos,
+        "llamadas_por_mensaje": {"graph": por_mensaje(graph, registro.mensajes),
+                                 "supabase": por_mensaje(supa, registro.mensajes),
+                                 "openai": por_mensaje(ia, registro.mensajes)},
+        "llamadas": {"graph": graph.llamadas, "supabase": supa.llamadas, "openai": ia.llamadas},
+        "errores_inyectados": {"graph": graph.errores, "supabase": supa.errores, "openai": ia.errores},
+    }
+
+
+# ===============================================================
+#  REPORTE Y COMPARACIÓN
+# ===============================================================
+def valor(resultados, ruta):
+    for parte in ruta.split("."):
+        resultados = (resultados or {}).get(parte)
+    return resultados
+
+
+def comparar(actual, base, tolerancia):
+    """Imprime la diferencia contra una corrida anterior; devuelve las regresiones."""
+    regresiones = []
+    print(f"\n📊 Comparación (tolerancia {tolerancia:.0%}):")
+    for ruta, mayor_mejor in METRICAS.items():
+        a, b = valor(actual, ruta), valor(base, ruta)
+        if a is None or not b: continue
+        cambio = (a - b) / b
+        peor = cambio < -tolerancia if mayor_mejor else cambio > tolerancia
+        if peor: regresiones.append(ruta)
+        print(f"  {'❌' if peor else '✅'} {ruta:32} {b:>10} -> {a:>10} ({cambio:+.1%})")
+    return regresiones
+
+
+def guardar(resultados, args):
+    os.makedirs(DIR_RESULTADOS, exist_ok=True)
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    fecha = datetime.now().strftime("%Y%m%d-%H%M%S")
+    ruta = args.salida or os.path.join(DIR_RESULTADOS, f"{fecha}{'-' + args.etiqueta if args.etiqueta else ''}.json")
+    config = {k: v for k, v in vars(args).items() if k not in ("salida", "comparar")}
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump({"fecha": fecha, "commit": commit, "config": config, "resultados": resultados},
+                  f, indent=2, ensure_ascii=False)
+    return ruta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--conversaciones", type=int, default=50, help="conversaciones simultáneas")
+    parser.add_argument("--mensajes", type=int, default=10, help="pasos por conversación")
+    parser.add_argument("--workers", type=int, default=1, help="workers de gunicorn")
+    parser.add_argument("--latencia-graph", type=float, default=0.15, help="segundos")
+    parser.add_argument("--latencia-supabase", type=float, default=0.05, help="segundos")
+    parser.add_argument("--latencia-openai", type=float, default=1.5, help="segundos")
+    parser.add_argument("--error-graph", type=float, default=0.0, help="fracción de envíos que fallan")
+    parser.add_argument("--error-supabase", type=float, default=0.0)
+    parser.add_argument("--error-openai", type=float, default=0.0)
+    parser.add_argument("--timeout-respuesta", type=float, default=30, help="segundos")
+    parser.add_argument("--pausa", type=float, default=0.3, help="silencio que marca el fin de una respuesta")
+    parser.add_argument("--env", action="append", default=[], metavar="CLAVE=VALOR",
+                        help="variable de entorno extra para app.py (repetible)")
+    parser.add_argument("--etiqueta", default="", help="sufijo del archivo de resultados")
+    parser.add_argument("--salida", help="ruta del JSON de resultados")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="cambio permitido antes de marcar regresión")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="muestra la salida de gunicorn")
+    args = parser.parse_args(argv)
+
+    random.seed(args.semilla)
+    resultados = correr(args)
+    print(json.dumps(resultados, indent=2, ensure_ascii=False))
+    print(f"\n💾 Resultados en {guardar(resultados, args)}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            base = json.load(f)["resultados"]
+        if comparar(resultados, base, args.tolerancia): sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""Revisa el detector de intenciones contra CASOS_INTENCIONES de app.py.
+
+Uso (desde la raíz del repo):
+
+    python -m benchmark.intenciones
+
+Sale con código 1 si alguna frase no da la intención esperada.
+"""
+import os
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    # app.py crea los clientes al importarse; no se conecta hasta usarlos
+    os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+    os.environ.setdefault("SUPABASE_KEY", "intenciones" * 4)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-intenciones")
+    sys.path.insert(0, RAIZ)
+    import app
+
+    fallos = app.detector_intenciones.verificar(app.CASOS_INTENCIONES)
+    for frase, esperada, obtenida in fallos:
+        print(f"❌ '{frase}': se esperaba {esperada}, se obtuvo {obtenida}")
+    print(f"{len(app.CASOS_INTENCIONES) - len(fallos)}/{len(app.CASOS_INTENCIONES)} casos correctos")
+    if fallos: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Servidores locales que imitan a Graph API, Supabase (PostgREST) y OpenAI.
+
+Solo implementan lo que usa app.py. Cada uno tiene latencia y tasa de error
+configurables y cuenta las llamadas que recibe para el reporte de carga.
+"""
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+RESPUESTA_IA = (
+    "📌 **Verified Tech Solutions** crea chatbots con IA para WhatsApp.\n\n"
+    "💡 Beneficios:\n- Atención **24/7**\n- Menos carga operativa\n\n"
+    "💰 Desde **$4,500 MXN/mes**.\n\n🚀 ¿Te agendo una demo?"
+)
+
+
+class ServidorStub(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, manejador, latencia=0.0, jitter=0.0, tasa_error=0.0):
+        super().__init__(("127.0.0.1", 0), manejador)
+        self.latencia = latencia
+        self.jitter = jitter
+        self.tasa_error = tasa_error
+        self.lock = threading.Lock()
+        self.llamadas = {}
+        self.errores = 0
+        self.hilo = None
+
+    def handle_error(self, request, client_address):
+        # Los clientes cierran conexiones keep-alive al terminar: no es un error
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def contar(self, nombre):
+        with self.lock:
+            self.llamadas[nombre] = self.llamadas.get(nombre, 0) + 1
+
+    def esperar(self):
+        if self.latencia or self.jitter:
+            time.sleep(max(0.0, self.latencia + random.uniform(-self.jitter, self.jitter)))
+
+    def falla(self):
+        if self.tasa_error and random.random() < self.tasa_error:
+            with self.lock: self.errores += 1
+            return True
+        return False
+
+    def iniciar(self):
+        self.hilo = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self.hilo.start()
+        return self
+
+    def detener(self):
+        self.shutdown()
+        self.server_close()
+
+    def reiniciar_contadores(self):
+        with self.lock:
+            self.llamadas = {}
+            self.errores = 0
+
+
+class ManejadorBase(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def leer_json(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        cuerpo = self.rfile.read(n) if n else b""
+        return json.loads(cuerpo) if cuerpo else None
+
+    def responder(self, codigo, datos, tipo="application/json"):
+        cuerpo = datos if isinstance(datos, bytes) else json.dumps(datos).encode()
+        self.send_response(codigo)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+
+# ===============================================================
+#  GRAPH API (WhatsApp)
+# ===============================================================
+class ManejadorGraph(ManejadorBase):
+    def do_POST(self):
+        srv = self.server
+        data = self.leer_json() or {}
+        srv.esperar()
+        tipo = "status" if "status" in data else data.get("type", "?")
+        srv.contar(f"POST /messages ({tipo})")
+        if srv.falla():
+            return self.responder(random.choice([429, 500, 503]), {"error": {"message": "stub"}})
+        if "to" in data: srv.registrar_envio(data["to"], data)
+        self.responder(200, {"messaging_product": "whatsapp", "messages": [{"id": f"wamid.stub{time.time_ns()}"}]})
+
+
+class StubGraph(ServidorStub):
+    """Registra la hora de cada envío por destinatario para medir latencia de punta a punta."""
+
+    def __init__(self, **kwargs):
+        super().__init__(ManejadorGraph, **kwargs)
+        self.cond = threading.Condition()
+        self.envios = {}  # telefono -> [(timestamp, payload)]
+
+    def registrar_envio(self, telefono, data):
+        with self.cond:
+            self.envios.setdefault(telefono, []).append((time.time(), data))
+            self.cond.notify_all()
+
+    def esperar_envio(self, telefono, desde, timeout):
+        """Hora del primer envío a `telefono` posterior a `desde`, o None."""
+        limite = time.time() + timeout
+        with self.cond:
+            while True:
+                for ts, _ in self.envios.get(telefono, ()):
+                    if ts >= desde: return ts
+                restante = limite - time.time()
+                if restante <= 0: return None
+                self.cond.wait(restante)
+
+    def total_envios(self, telefono):
+        with self.cond:
+            return len(self.envios.get(telefono, ()))
+
+
+# ===============================================================
+#  SUPABASE (PostgREST)
+# ===============================================================
+class ManejadorSupabase(ManejadorBase):
+    def _tabla(self):
+        url = urlparse(self.path)
+        tabla = url.path.rsplit("/", 1)[-1]
+        return tabla, parse_qs(url.query)
+
+    def _atender(self):
+        srv = self.server
+        tabla, query = self._tabla()
+        data = self.leer_json()
+        srv.esperar()
+        srv.contar(f"{self.command} {tabla}")
+        if srv.falla():
+            return self.responder(503, {"message": "stub"})
+        prefer = self.headers.get("Prefer") or ""
+        filas = data if isinstance(data, list) else [data] if data else []
+        self.responder(200 if self.command != "POST" else 201, srv.ejecutar(self.command, tabla, query, filas, prefer))
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _atender
+
+
+class StubSupabase(ServidorStub):
+    """Tablas `clientes`, `mensajes` y `webhook_eventos` en memoria."""
+
+    LLAVES = {"clientes": "telefono", "webhook_eventos": "wamid"}
+
+    def __init__(self, **kwargs):
+        super().__init__(ManejadorSupabase, **kwargs)
+        self.tablas = {"clientes": {}, "webhook_eventos": {}, "mensajes": []}
+
+    @staticmethod
+    def _filtro(query, campo):
+        valor = query.get(campo, [""])[0]
+        if valor.startswith("eq."): return [valor[3:]]
+        if valor.startswith("in."): return unquote(valor[3:]).strip("()").split(",")
+        return None
+
+    def ejecutar(self, metodo, tabla, query, filas, prefer):
+        with self.lock:
+            if tabla == "mensajes":
+                if metodo == "POST":
+                    self.tablas["mensajes"].extend(filas)
+                    return filas
+                telefonos = self._filtro(query, "telefono") or []
+                limite = int(query.get("limit", ["1000"])[0])
+                encontrados = [m for m in self.tablas["mensajes"] if m.get("telefono") in telefonos]
+                encontrados.sort(key=lambda m: m.get("created_at", ""), reverse=True)
+                return encontrados[:limite]
+
+            llave = self.LLAVES.get(tabla)
+            if llave is None: return []
+            datos = self.tablas[tabla]
+            valores = self._filtro(query, llave)
+            if metodo == "GET":
+                return [datos[v] for v in valores or datos if v in datos]
+            if metodo == "DELETE":
+                return [datos.pop(v) for v in valores or [] if v in datos]
+            if metodo == "PATCH":
+                for v in valores or []:
+                    if v in datos: datos[v].update(filas[0])
+                return [datos[v] for v in valores or [] if v in datos]
+            # POST: insert / upsert
+            resultado = []
+            for fila in filas:
+                clave = fila.get(llave)
+                if clave in datos:
+                    if "ignore-duplicates" in prefer: continue
+                    datos[clave].update(fila)
+                else:
+                    datos[clave] = dict(fila)
+                resultado.append(dict(datos[clave]))
+            return resultado
+
+
+# ===============================================================
+#  OPENAI (chat.completions)
+# ===============================================================
+class ManejadorOpenAI(ManejadorBase):
+    def do_POST(self):
+        srv = self.server
+        data = self.leer_json() or {}
+        stream = bool(data.get("stream"))
+        srv.contar("POST /chat/completions" + (" (stream)" if stream else ""))
+        if srv.falla():
+            srv.esperar()
+            return self.responder(500, {"error": {"message": "stub", "type": "server_error"}})
+        texto = srv.respuesta
+        uso = {"prompt_tokens": sum(len(m.get("content", "")) // 4 for m in data.get("messages", [])),
+               "completion_tokens": len(texto) // 4}
+        uso["total_tokens"] = uso["prompt_tokens"] + uso["completion_tokens"]
+        base = {"id": f"chatcmpl-stub{time.time_ns()}", "created": int(time.time()), "model": data.get("model", "stub")}
+        if not stream:
+            srv.esperar()
+            return self.responder(200, {**base, "object": "chat.completion", "usage": uso, "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": "stop"}]})
+
+        # SSE en chunked encoding: la latencia se reparte entre los fragmentos
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        trozos = [texto[i:i + 12] for i in range(0, len(texto), 12)]
+        pausa = srv.latencia / max(len(trozos), 1)
+        for i, trozo in enumerate(trozos):
+            time.sleep(pausa)
+            evento = {**base, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {"content": trozo} if i else {"role": "assistant", "content": trozo},
+                 "finish_reason": None}]}
+            self._chunk(f"data: {json.dumps(evento)}\n\n")
+        fin = {**base, "object": "chat.completion.chunk", "usage": uso,
+               "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        self._chunk(f"data: {json.dumps(fin)}\n\ndata: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, texto):
+        datos = texto.encode()
+        self.wfile.write(f"{len(datos):x}\r\n".encode() + datos + b"\r\n")
+        self.wfile.flush()
+
+
+class StubOpenAI(ServidorStub):
+    def __init__(self, respuesta=RESPUESTA_IA, **kwargs):
+        super().__init__(ManejadorOpenAI, **kwargs)
+        self.respuesta = respuesta
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# app.py crea los clientes de Supabase y OpenAI al importarse; no se conecta hasta usarlos
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_KEY", "pruebas" * 6)
+os.environ.setdefault("OPENAI_API_KEY", "sk-pruebas")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,147 @@
+"""Pruebas de la parte concurrente: despachador, escritor diferido y fragmentador.
+
+    python -m pytest -q
+"""
+import random
+import threading
+import time
+
+import app
+
+
+# ===============================================================
+#  DESPACHADOR
+# ===============================================================
+def test_despachador_respeta_el_orden_por_numero():
+    procesados = {}
+    en_curso = set()
+    solapados = []
+    lock = threading.Lock()
+
+    def manejador(numero, i):
+        with lock:
+            if numero in en_curso: solapados.append(numero)
+            en_curso.add(numero)
+        time.sleep(random.uniform(0, 0.003))
+        with lock:
+            en_curso.discard(numero)
+            procesados.setdefault(numero, []).append(i)
+
+    despachador = app.Despachador(manejador, num_workers=4, max_pendientes=1000)
+    numeros = [f"52550000000{n}" for n in range(5)]
+    for i in range(30):
+        for numero in numeros:
+            assert despachador.encolar(numero, numero, i)
+    despachador.detener(timeout=10)
+
+    assert procesados == {numero: list(range(30)) for numero in numeros}
+    assert not solapados
+
+
+def test_encolar_devuelve_false_con_la_cola_llena():
+    liberar = threading.Event()
+    despachador = app.Despachador(lambda i: liberar.wait(5), num_workers=1, max_pendientes=2)
+    try:
+        assert despachador.encolar("5255", 1)
+        assert despachador.encolar("5255", 2)
+        assert not despachador.encolar("5256", 3)
+    finally:
+        liberar.set()
+        despachador.detener(timeout=5)
+
+
+def test_detener_drena_la_cola_y_rechaza_trabajo_nuevo():
+    hechos = []
+    despachador = app.Despachador(lambda i: (time.sleep(0.01), hechos.append(i)), num_workers=2,
+                                  max_pendientes=100)
+    for i in range(20):
+        assert despachador.encolar(f"5255{i % 3}", i)
+    despachador.detener(timeout=5)
+
+    assert sorted(hechos) == list(range(20))
+    assert despachador.pendientes() == 0
+    assert not despachador.encolar("5255", 99)
+    assert not any(hilo.is_alive() for hilo in despachador._hilos)
+
+
+def test_detener_respeta_el_timeout_si_un_trabajo_no_termina():
+    liberar = threading.Event()
+    despachador = app.Despachador(lambda i: liberar.wait(5), num_workers=1, max_pendientes=10)
+    despachador.encolar("5255", 1)
+    inicio = time.monotonic()
+    despachador.detener(timeout=0.2)
+    assert time.monotonic() - inicio < 1
+    liberar.set()
+
+
+# ===============================================================
+#  ESCRITOR DE MENSAJES (write-behind)
+# ===============================================================
+class SupabaseFalso:
+    """Imita supabase.table(...).insert(...).execute(); falla las primeras `fallos` veces."""
+
+    def __init__(self, fallos=0):
+        self.fallos = fallos
+        self.lotes = []
+
+    def table(self, tabla):
+        return self
+
+    def insert(self, filas):
+        self._filas = list(filas)
+        return self
+
+    def execute(self):
+        if self.fallos:
+            self.fallos -= 1
+            raise RuntimeError("supabase caído")
+        self.lotes.append(self._filas)
+
+
+def test_escritor_guarda_por_lotes_y_drena_al_detener(monkeypatch):
+    falso = SupabaseFalso()
+    monkeypatch.setattr(app, "supabase", falso)
+    escritor = app.EscritorMensajes("mensajes", lote=3, intervalo=60, max_buffer=100)
+    for i in range(7): escritor.agregar({"telefono": "5255", "n": i})
+    escritor.detener(timeout=5)
+
+    assert [len(lote) for lote in falso.lotes] == [3, 3, 1]
+    assert [fila["n"] for lote in falso.lotes for fila in lote] == list(range(7))
+
+
+def test_escritor_reintenta_con_backoff_sin_perder_filas(monkeypatch):
+    falso = SupabaseFalso(fallos=1)
+    monkeypatch.setattr(app, "supabase", falso)
+    escritor = app.EscritorMensajes("mensajes", lote=2, intervalo=0.05, max_buffer=100)
+    escritor.agregar({"telefono": "5255", "n": 0})
+    escritor.agregar({"telefono": "5255", "n": 1})
+    limite = time.monotonic() + 5
+    while not falso.lotes and time.monotonic() < limite: time.sleep(0.01)
+    escritor.detener(timeout=5)
+
+    assert escritor._espera_error == 0
+    assert [fila["n"] for lote in falso.lotes for fila in lote] == [0, 1]
+
+
+# ===============================================================
+#  FRAGMENTADOR DE RESPUESTAS
+# ===============================================================
+def fragmentar(texto, max_mensajes, min_caracteres=160, paso=7):
+    fragmentador = app.FragmentadorRespuesta(max_mensajes, min_caracteres)
+    bloques = []
+    for i in range(0, len(texto), paso): bloques += fragmentador.agregar(texto[i:i + paso])
+    return bloques + fragmentador.cerrar()
+
+
+def test_fragmentador_corta_en_parrafos():
+    texto = "📌 Intro " + "a" * 200 + "\n\n💡 Beneficios " + "b" * 200 + "\n\n🚀 ¿Demo?"
+    assert fragmentar(texto, 4) == ["📌 Intro " + "a" * 200, "💡 Beneficios " + "b" * 200, "🚀 ¿Demo?"]
+
+
+def test_fragmentador_nunca_pasa_del_maximo_de_mensajes():
+    lista = "".join(f"- Punto {i}: " + "detalle " * 20 + "\n" for i in range(70))
+    for maximo in (1, 2, 4):
+        bloques = fragmentar(lista, maximo)
+        assert len(bloques) == maximo
+        assert all(len(b) <= app.LIMITE_WHATSAPP for b in bloques)
+        assert bloques[-1].endswith("…")